@@ -27,7 +27,7 @@ import tkinter.font
 
 from tkinter import ttk
 
-from .lib import kanji_data, matches, __version__
+from .lib import kanji_data, matches, record, __version__
 
 NAME, TITLE = "kanjidraw", "Kanji Draw"
 HEIGHT = WIDTH = 400
@@ -58,12 +58,14 @@ def frame_button(master, size, **kw):
   return frame, btn
 
 def gui(stdout = False, oneshot = False, multiple = False,      # {{{1
-        dark = False):
+        dark = False, record_file = None):
   """Tkinter GUI."""
 
   nogrid = os.environ.get("KANJIDRAW_NOGRID") in ("1", "true", "yes")
   if os.environ.get("KANJIDRAW_DARK") in ("1", "true", "yes"):
     dark = True
+  record_file = record_file or os.environ.get("KANJIDRAW_RECORD")
+  if record_file: record(record_file)
 
   win = tk.Tk()
   win.title(TITLE)
@@ -270,6 +272,8 @@ def main():                                                     # {{{1
                         "pressing 'c' or quitting")
   p.add_argument("-d", "--dark", action = "store_true",
                  help = "use dark theme")
+  p.add_argument("-r", "--record", metavar = "FILE", dest = "record_file",
+                 help = "record queries to FILE (for replay)")
   p.add_argument("--version", action = "version",
                  version = "%(prog)s {}".format(__version__))
   gui(**vars(p.parse_args()))
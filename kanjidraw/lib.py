@@ -71,9 +71,10 @@ Handwritten kanji recognition: library.
 
 """                                                             # }}}1
 
-import gzip, functools, itertools, json, os, re, sys
+import gzip, functools, itertools, json, operator, os, re, sys, threading, time
 import xml.etree.ElementTree as ET
 
+from array import array
 from collections import namedtuple
 from enum import Enum
 
@@ -95,6 +96,8 @@ CLOSE_WEIGHT            = 0.7
 MAX_RESULTS             = 25
 CUTOFF                  = 0.75
 
+AnytimeMatches = namedtuple("AnytimeMatches", "matches partial coverage")
+
 class Direction(Enum):                                          # {{{1
   X, N, NE, E, SE, S, SW, W, NW = range(-1, 8)
 
@@ -167,6 +170,7 @@ class Kanji(tuple):                                             # {{{1
   def __init__(self, lines, fuzzy = False):
     self._fuzzy = self if fuzzy else None
     self._starts = self._ends = self._dirs = self._moves = None
+    self._signature = None
 
   @property
   def fuzzy(self):
@@ -198,6 +202,12 @@ class Kanji(tuple):                                             # {{{1
       self._moves = tuple(map(Direction.of_move, self[1:], self[:-1]))
     return self._moves
 
+  @property
+  def signature(self):
+    if self._signature is None:
+      self._signature = _signature(self)
+    return self._signature
+
   def minus_1_stroke(self):
     fuzzy = self._fuzzy is self
     for i in range(len(self)):
@@ -218,6 +228,227 @@ def _fuzzy_sort(lines):                                         # {{{1
   return tuple( x[2] for x in sorted(result) )
                                                                 # }}}1
 
+# lookup tables for the 0-255 grid; index = col * 3 + row
+_LOC_TABLE  = bytes( 0 if v < 85 else (1 if v < 170 else 2) for v in range(256) )
+_LOCATIONS  = tuple( Location((i // 3, i % 3)) for i in range(9) )
+_DIRECTIONS = tuple( Direction(v) for v in range(-1, 8) )
+
+def _direction_table():                                         # {{{1
+  """
+  Direction lookup table (index = (dy + 255) * 511 + (dx + 255)) w/
+  value + 1 of Direction.of_line((0, 0, dx, dy)); built per |dy| from
+  runs of stroke categories for |dx| = 0..255, instead of per (dx, dy).
+
+  >>> _DIR_TABLE == bytes( Direction.of_line((0, 0, dx, dy)).value + 1
+  ...                      for dy in range(-255, 256) for dx in range(-255, 256) )
+  True
+  """
+  X, H, D, V = range(4)   # none, horizontal, diagonal, vertical
+  def tbl(*ds): return bytes( d.value + 1 for d in ds ) + bytes(252)
+  D_ = Direction
+  up_l, up_r = tbl(D_.X, D_.W, D_.NW, D_.N), tbl(D_.X, D_.E, D_.NE, D_.N)
+  dn_l, dn_r = tbl(D_.X, D_.W, D_.SW, D_.S), tbl(D_.X, D_.E, D_.SE, D_.S)
+  rows = {}
+  for ady in range(256):
+    c = DIAGONAL_THRESHOLD * ady // 256
+    m = max(-(-256 * ady // DIAGONAL_THRESHOLD), ady + 1)
+    half = bytearray([V] * (c + 1) + [D] * (ady - c) + [D] * (m - ady - 1)
+                     + [H] * (256 - m))[:256]
+    if ady < DIRECTION_THRESHOLD:
+      half[:DIRECTION_THRESHOLD] = bytes([X]) * DIRECTION_THRESHOLD
+    half = bytes(half)
+    rows[-ady] = half[:0:-1].translate(up_l) + half.translate(up_r)
+    rows[ady]  = half[:0:-1].translate(dn_l) + half.translate(dn_r)
+  return b"".join( rows[dy] for dy in range(-255, 256) )
+                                                                # }}}1
+
+_DIR_TABLE = _direction_table()
+
+def _coords(coords):
+  """
+  Coordinates as a flat uint8 buffer when they are all on the 0-255
+  grid (allowing table lookups), otherwise as a list.
+  """
+  try:
+    mv = memoryview(coords)
+  except TypeError:
+    pass
+  else:
+    if mv.format == "B" and mv.c_contiguous: return mv.cast("B")
+  cs = list(coords)
+  if all( 0 <= v <= 255 and v == int(v) for v in cs ):
+    return array("B", map(int, cs))
+  return cs
+
+def _quantise(coords):
+  """Coordinates as a flat uint8 buffer (truncated & clamped to 0-255)."""
+  try:
+    mv = memoryview(coords)
+  except TypeError:
+    pass
+  else:
+    if mv.format == "B" and mv.c_contiguous: return mv.cast("B")
+  return array("B", ( min(max(int(v), 0), 255) for v in coords ))
+
+def kanji_batch(coords, counts):                                # {{{1
+  """
+  Bulk feature extraction for many queries at once.
+
+  Takes a flat sequence of stroke coordinates (four per stroke; e.g. a
+  list, an array.array or a NumPy array) and the number of strokes of
+  each query; returns a list of Kanji with their strict and fuzzy
+  features already computed, ready to be passed to matches() etc.
+
+  Directions are looked up in a table when all coordinates are on the
+  0-255 integer grid the database uses (e.g. uint8 arrays); otherwise
+  they are computed exactly, like Kanji does.
+
+  >>> a = [[125.5875, 28.6875, 48.45, 196.35], [104.55, 93.7125, 195.7125, 223.125]]
+  >>> b = [[123.675, 31.875, 102.6375, 221.85], [13.3875, 114.1125, 44.625, 177.8625], [236.5125, 63.1125, 221.2125, 219.3]]
+  >>> ka, kb = kanji_batch([ v for s in a + b for v in s ], [2, 3])
+  >>> features = lambda k: (tuple(map(tuple, k)), k.dirs, k.moves, k.starts, k.ends)
+  >>> features(ka) == features(Kanji(a)) and features(kb) == features(Kanji(b))
+  True
+  >>> features(kb.fuzzy) == features(Kanji(b).fuzzy)
+  True
+  >>> kanji_batch(memoryview(bytes(range(16)))[::2], [2])
+  [((0, 2, 4, 6), (8, 10, 12, 14))]
+  >>> list(fuzzy_matches(kb)) == list(fuzzy_matches(b))
+  True
+
+  >>> import random
+  >>> r = random.Random(1)
+  >>> qs = [ [ [ r.randint(0, 255) for _ in range(4) ] for _ in range(r.randint(1, 9)) ]
+  ...        for _ in range(200) ]
+  >>> ks = kanji_batch(array("B", ( v for q in qs for s in q for v in s )),
+  ...                  [ len(q) for q in qs ])
+  >>> all( features(k) == features(Kanji(q)) and
+  ...      features(k.fuzzy) == features(Kanji(q).fuzzy) for k, q in zip(ks, qs) )
+  True
+
+  """
+  cs, spans, offset = _coords(coords), [], 0
+  for n in counts:
+    spans.append((offset, n))
+    offset += 4 * n
+  if offset != len(cs):
+    raise ValueError("coordinates do not match stroke counts")
+  return _kanji_spans(cs, spans)
+                                                                # }}}1
+
+def _kanji_spans(cs, spans):                                    # {{{1
+  """Kanji w/ features for (offset, strokes) spans of coordinates cs."""
+  loc, dirs = _LOC_TABLE, _DIR_TABLE
+  grid = not isinstance(cs, list)
+
+  def direction(x1, y1, x2, y2):
+    if grid:
+      return _DIRECTIONS[dirs[(y2 - y1 + 255) * 511 + (x2 - x1 + 255)]]
+    return Direction.of_line((x1, y1, x2, y2))
+
+  def location(x, y):
+    if grid: return loc[x] * 3 + loc[y]
+    return loc[min(max(int(x), 0), 255)] * 3 + loc[min(max(int(y), 0), 255)]
+
+  def kanji(lines, starts, ends):
+    k = Kanji(lines)
+    k._starts = tuple( _LOCATIONS[i] for i in starts )
+    k._ends   = tuple( _LOCATIONS[i] for i in ends )
+    k._dirs   = tuple( direction(*l) for l in lines )
+    k._moves  = tuple( direction(*(lines[i][2:] + lines[i-1][:2]))
+                       for i in range(1, len(lines)) )
+    return k
+
+  result = []
+  for offset, n in spans:
+    lines, starts, ends, fuzzy = [], [], [], []
+    for i in range(offset, offset + 4 * n, 4):
+      x1, y1, x2, y2 = line = tuple(cs[i:i+4])
+      s, e = location(x1, y1), location(x2, y2)
+      lines.append(line); starts.append(s); ends.append(e)
+      fuzzy.append((s, e, line) if s <= e else (e, s, (x2, y2, x1, y1)))
+    fuzzy.sort()
+    k, f = kanji(tuple(lines), starts, ends), \
+           kanji(tuple( x[2] for x in fuzzy ),
+                 [ x[0] for x in fuzzy ], [ x[1] for x in fuzzy ])
+    k._fuzzy = f._fuzzy = f
+    result.append(k)
+  return result
+                                                                # }}}1
+
+# binary wire format: per query, a uint8 stroke count followed by four
+# uint8 coordinates (x1, y1, x2, y2) per stroke; a batch is simply a
+# concatenation of queries.
+
+def encode_strokes(lines):
+  """
+  Encode strokes in the binary wire format; coordinates are truncated
+  to the 0-255 grid.
+
+  >>> encode_strokes([[125.5875, 28.6875, 48.45, 196.35], [104.55, 93.7125, 195.7125, 223.125]])
+  b'\\x02}\\x1c0\\xc4h]\\xc3\\xdf'
+  >>> encode_strokes([[1, 2, 3], [4, 5, 6, 7, 8]])
+  Traceback (most recent call last):
+  ...
+  ValueError: strokes must have 4 coordinates
+  """
+  lines = list(lines)
+  if len(lines) > 255: raise ValueError("too many strokes")
+  if any( len(l) != 4 for l in lines ):
+    raise ValueError("strokes must have 4 coordinates")
+  return bytes([len(lines)]) + bytes(_quantise([ v for l in lines for v in l ]))
+
+def encode_batch(queries):
+  """Encode a batch of queries in the binary wire format."""
+  return b"".join(map(encode_strokes, queries))
+
+def decode_strokes(data):
+  """
+  Decode a single query in the binary wire format (bytes or any uint8
+  buffer) to a Kanji with its features already computed.
+
+  >>> decode_strokes(b"\\x01\\x00\\x00\\xff\\x00")
+  ((0, 0, 255, 0),)
+  """
+  ks = decode_batch(data)
+  if len(ks) != 1: raise ValueError("expected a single query")
+  return ks[0]
+
+def decode_batch(data):
+  """
+  Decode a batch of queries in the binary wire format (bytes or any
+  uint8 buffer) to a list of Kanji with their features already
+  computed; does not copy the data.
+
+  >>> strokes = [[125.5875, 28.6875, 48.45, 196.35], [104.55, 93.7125, 195.7125, 223.125]]
+  >>> data = encode_batch([strokes, [[0, 0, 255, 0]]])
+  >>> len(data)
+  14
+  >>> ka, kb = decode_batch(memoryview(data))
+  >>> kb
+  ((0, 0, 255, 0),)
+  >>> for s, k in list(matches(data[:9]))[:3]: print(int(s), k)
+  99 人
+  96 九
+  96 乂
+  >>> decode_batch(memoryview(data).cast("b"))
+  Traceback (most recent call last):
+  ...
+  TypeError: expected a byte buffer, not format 'b'
+  >>> decode_batch(memoryview(b"\\x01\\x00\\x00\\x00\\x00\\x00\\xff\\x00\\x00\\x00")[::2])
+  [((0, 0, 255, 0),)]
+  """
+  cs = memoryview(data)
+  if cs.format != "B":
+    raise TypeError("expected a byte buffer, not format {!r}".format(cs.format))
+  cs, spans, offset = cs.cast("B") if cs.c_contiguous else bytes(cs), [], 0
+  while offset < len(cs):
+    n = cs[offset]
+    spans.append((offset + 1, n))
+    offset += 1 + 4 * n
+  if offset != len(cs): raise ValueError("truncated data")
+  return _kanji_spans(cs, spans)
+
 def strict_match(a, b):                                         # {{{1
   """Strict comparison; returns a percentage score as a float."""
   if len(a) != len(b): raise ValueError("must have same length")
@@ -279,18 +510,41 @@ def _match_offby1(a, b, match):
   return max( match(a, c) for c in b.minus_1_stroke() )
 
 def matches(lines, data = None, fuzzy = False, offby1 = False,
-            max_results = MAX_RESULTS, cutoff = CUTOFF):
+            max_results = MAX_RESULTS, cutoff = CUTOFF, timeout = None):
   """
   Find best matches; yields a (score, kanji) pair for the first
   max_results matches that have a score >= max_score * cutoff.
+
+  The strokes can also be passed as a query in the binary wire format
+  (see encode_strokes()).
+
+  With a timeout (in seconds), candidates are scored most promising
+  first (by a signature cached on each Kanji; ordering may take at
+  most half the budget) and scoring stops when the time budget runs
+  out; returns an AnytimeMatches of the (score, kanji) pairs found so
+  far, whether the result is partial, and the fraction of candidates
+  scored.
+
+  >>> strokes = [[125.5875, 28.6875, 48.45, 196.35], [104.55, 93.7125, 195.7125, 223.125]]
+  >>> ms = matches(strokes, timeout = 60)
+  >>> ms.partial, ms.coverage, ms.matches == list(matches(strokes))
+  (False, 1.0, True)
+  >>> matches(strokes, timeout = 0)
+  AnytimeMatches(matches=[], partial=True, coverage=0.0)
   """
   data_items = _data_items_offby1 if offby1 else _data_items
   if offby1:
     match = fuzzy_match_offby1 if fuzzy else strict_match_offby1
   else:
     match = fuzzy_match if fuzzy else strict_match
+  if isinstance(lines, (bytes, bytearray, memoryview)):
+    lines = decode_strokes(lines)
   if not isinstance(lines, Kanji): lines = Kanji(lines)
+  if record._file is not None: _record(lines, fuzzy, offby1)
   if fuzzy: lines = lines.fuzzy
+  if timeout is not None:
+    return _anytime_matches(lines, data, max_results, cutoff, match,
+                            data_items, fuzzy, time.monotonic() + timeout)
   return _matches(lines, data, max_results, cutoff, match, data_items)
 
 def strict_matches(*a, **kw):
@@ -322,6 +576,88 @@ def _matches(lines, data, max_results, cutoff, match, data_items):
   mm = ms[0][0] * cutoff
   return itertools.takewhile(lambda m: m[0] >= mm, ms[:max_results])
 
+def _anytime_matches(lines, data, max_results, cutoff, match,   # {{{1
+                     data_items, fuzzy, deadline):
+  now = time.monotonic()
+  items = _order_candidates(lines, data_items(lines, data or kanji_data()),
+                            fuzzy, now + (deadline - now) / 2)
+  ms = []
+  for k, l in items:
+    if time.monotonic() >= deadline: break
+    ms.append((match(lines, l), k))
+  ms.sort(reverse = True)
+  mm = ms[0][0] * cutoff if ms else 0
+  return AnytimeMatches(
+    list(itertools.takewhile(lambda m: m[0] >= mm, ms[:max_results])),
+    len(ms) < len(items), len(ms) / len(items) if items else 1.0
+  )
+                                                                # }}}1
+
+def _order_candidates(lines, items, fuzzy, deadline):
+  """
+  Order (kanji, lines) candidates by signature distance, most promising
+  first; candidates not reached by the deadline are appended unordered.
+
+  >>> kanji = kanji_data()[12]["幅"]
+  >>> for fuzzy in [False, True]:
+  ...   lines = kanji.fuzzy if fuzzy else kanji
+  ...   items = _order_candidates(lines, kanji_data()[12].items(), fuzzy, float("inf"))
+  ...   print(items[0][0], len(items))
+  幅 580
+  幅 580
+  >>> items = _order_candidates(kanji, kanji_data()[12].items(), False, 0)
+  >>> items == list(kanji_data()[12].items())
+  True
+  """
+  sig, items, keyed, rest = lines.signature, list(items), [], []
+  for i, (k, l) in enumerate(items):
+    if time.monotonic() >= deadline:
+      rest = items[i:]
+      break
+    l_sig = (l.fuzzy if fuzzy else l).signature
+    keyed.append((sum(map(abs, map(operator.sub, sig, l_sig))), i, k, l))
+  keyed.sort()
+  return [ (k, l) for _, _, k, l in keyed ] + rest
+
+def _signature(lines):
+  """Cheap signature: histograms of stroke directions & locations."""
+  h = [0] * 27
+  for d in lines.dirs:   h[d.value + 1] += 1
+  for l in lines.starts: h[9 + l.value[0] * 3 + l.value[1]] += 1
+  for l in lines.ends:   h[18 + l.value[0] * 3 + l.value[1]] += 1
+  return tuple(h)
+
+def record(file = None):
+  """
+  Record the strokes and mode of each matches() call to file; None
+  stops recording.
+
+  The log is append-only, one compact JSON array per line:
+  [fuzzy, offby1, strokes].
+
+  >>> import tempfile
+  >>> with tempfile.TemporaryDirectory() as d:
+  ...   log = os.path.join(d, "queries.log")
+  ...   record(log)
+  ...   _ = matches([[0, 0, 255, 0]], fuzzy = True)
+  ...   _ = matches(iter([[0, 0, 0, 255]]))
+  ...   record(None)
+  ...   with open(log) as fh: print(fh.read(), end = "")
+  [1,0,[[0,0,255,0]]]
+  [0,0,[[0,0,0,255]]]
+
+  """
+  with record._lock:
+    if record._file is not None: record._file.close()
+    record._file = open(file, "a", buffering = 1) if file is not None else None
+record._file, record._lock = None, threading.Lock()
+
+def _record(lines, fuzzy, offby1):
+  q = [int(fuzzy), int(offby1), [ list(l) for l in lines ]]
+  line = json.dumps(q, separators = (",", ":")) + "\n"
+  with record._lock:
+    if record._file is not None: record._file.write(line)
+
 def kanji_data():
   if kanji_data._data is None: kanji_data._data = _load_json()
   return kanji_data._data
@@ -0,0 +1,177 @@
+#!/usr/bin/python3
+# encoding: utf-8
+
+# --                                                            ; {{{1
+#
+# File        : kanjidraw/replay.py
+# Maintainer  : FC Stegerman <flx@obfusk.net>
+# Date        : 2022-07-26
+#
+# Copyright   : Copyright (C) 2022  FC Stegerman
+# Version     : v0.2.3
+# License     : AGPLv3+
+#
+# --                                                            ; }}}1
+
+                                                                # {{{1
+r"""
+
+Handwritten kanji recognition: replay recorded queries.
+
+>>> import os, tempfile
+>>> with tempfile.TemporaryDirectory() as d:
+...   log = os.path.join(d, "queries.log")
+...   record(log)
+...   for s in ([[0, 0, 255, 0]], [[125, 28, 48, 196], [104, 93, 195, 223]]):
+...     _ = matches(s)
+...   _ = matches([[0, 0, 255, 0]], fuzzy = True, offby1 = True)
+...   record(None)
+...   queries = list(load_log(log))
+>>> queries[1]
+([[125, 28, 48, 196], [104, 93, 195, 223]], False, False)
+>>> stats = replay(queries, repeat = 2)
+>>> stats["queries"], sorted(stats)
+(6, ['elapsed', 'max', 'p50', 'p90', 'p99', 'queries', 'throughput'])
+>>> stats["p50"] <= stats["p90"] <= stats["p99"] <= stats["max"]
+True
+>>> stats = replay(queries, rate = 1000)
+>>> stats["queries"], stats["elapsed"] >= 0.002
+(3, True)
+>>> replay(queries + [([[0, 0, 255]], False, False)], rate = 1000)
+Traceback (most recent call last):
+...
+ValueError: not enough values to unpack (expected 4, got 3)
+
+"""                                                             # }}}1
+
+import argparse, json, sys, time
+
+from concurrent.futures import ProcessPoolExecutor
+
+from .lib import kanji_data, matches, record, __version__
+
+NAME = "kanjidraw-replay"
+PERCENTILES = (50, 90, 99)
+
+def load_log(file):
+  """Load queries recorded by record(); yields (strokes, fuzzy, offby1)."""
+  with open(file) as fh:
+    for line in fh:
+      if line.strip():
+        fuzzy, offby1, strokes = json.loads(line)
+        yield strokes, bool(fuzzy), bool(offby1)
+
+def replay(queries, rate = None, concurrency = 1, repeat = 1):  # {{{1
+  """
+  Replay queries against matches(); returns a dict with the number of
+  queries, elapsed time, throughput (queries/s), and latency (s)
+  percentiles & max.
+
+  Without a rate, each of the concurrency workers runs queries back to
+  back and latency is the time spent in matches().  With a rate
+  (queries/s), queries are sent on a fixed schedule and latency
+  includes time spent waiting for a worker.
+
+  Workers are started, and their caches filled by running one query
+  per stroke count & mode, before the timing starts.
+  """
+  if rate is not None and rate <= 0: raise ValueError("rate must be > 0")
+  if concurrency < 1: raise ValueError("concurrency must be >= 1")
+  queries = list(queries) * repeat
+  warm = _warm_up_queries(queries)
+  _warm_up(warm)  # fill caches before forking & timing
+  if rate is None and concurrency == 1:
+    start = time.monotonic()
+    lats = list(map(_query, queries))
+  else:
+    lats, futures = [], []
+    with ProcessPoolExecutor(concurrency) as ex:
+      list(ex.map(_warm_up, [warm] * concurrency))  # start workers
+      start = time.monotonic()
+      if rate is None:
+        lats = list(ex.map(_query, queries, chunksize = 16))
+      else:
+        for i, q in enumerate(queries):
+          t = start + i / rate
+          d = t - time.monotonic()
+          if d > 0: time.sleep(d)
+          f = ex.submit(_query, q)
+          f.add_done_callback(_latency(lats, t))
+          futures.append(f)
+    for f in futures: f.result()
+  elapsed = time.monotonic() - start
+  stats = dict(queries = len(queries), elapsed = elapsed,
+               throughput = len(queries) / elapsed if elapsed else 0.0,
+               max = max(lats, default = 0.0))
+  lats.sort()
+  for p in PERCENTILES:
+    stats["p{}".format(p)] = _percentile(lats, p)
+  return stats
+                                                                # }}}1
+
+def _warm_up_queries(queries):
+  """One query per stroke count & mode."""
+  qs = {}
+  for q in queries:
+    qs.setdefault((len(q[0]), q[1], q[2]), q)
+  return list(qs.values())
+
+def _warm_up(queries):
+  kanji_data()
+  for q in queries: _query(q)
+
+def _latency(lats, t):
+  def f(future):
+    if future.exception() is None: lats.append(time.monotonic() - t)
+  return f
+
+def _query(q):
+  strokes, fuzzy, offby1 = q
+  t = time.monotonic()
+  for _ in matches(strokes, fuzzy = fuzzy, offby1 = offby1): pass
+  return time.monotonic() - t
+
+def _positive(type):
+  def f(s):
+    v = type(s)
+    if v <= 0: raise argparse.ArgumentTypeError("must be > 0: {}".format(s))
+    return v
+  f.__name__ = type.__name__
+  return f
+
+def _percentile(xs, p):
+  """Nearest-rank percentile of sorted xs."""
+  if not xs: return 0.0
+  return xs[max(0, -(-len(xs) * p // 100) - 1)]
+
+def main():                                                     # {{{1
+  p = argparse.ArgumentParser(prog = NAME)
+  p.add_argument("log", metavar = "LOG",
+                 help = "query log (see kanjidraw --record)")
+  p.add_argument("-r", "--rate", type = _positive(float),
+                 help = "queries per second (default: as fast as possible)")
+  p.add_argument("-c", "--concurrency", type = _positive(int), default = 1,
+                 help = "number of worker processes (default: 1)")
+  p.add_argument("-n", "--repeat", type = _positive(int), default = 1,
+                 help = "replay the log N times (default: 1)")
+  p.add_argument("--version", action = "version",
+                 version = "%(prog)s {}".format(__version__))
+  args = p.parse_args()
+  stats = replay(load_log(args.log), rate = args.rate,
+                 concurrency = args.concurrency, repeat = args.repeat)
+  print("queries:    {}".format(stats["queries"]))
+  print("elapsed:    {:.3f} s".format(stats["elapsed"]))
+  print("throughput: {:.1f} q/s".format(stats["throughput"]))
+  for k in ["p{}".format(p) for p in PERCENTILES] + ["max"]:
+    print("{:11} {:.1f} ms".format(k + ":", stats[k] * 1000))
+                                                                # }}}1
+
+if __name__ == "__main__":
+  if "--doctest" in sys.argv:
+    verbose = "--verbose" in sys.argv
+    import doctest
+    if doctest.testmod(verbose = verbose)[0]: sys.exit(1)
+  else:
+    main()
+
+# vim: set tw=70 sw=2 sts=2 et fdm=marker :
@@ -39,7 +39,8 @@ setuptools.setup(
   packages          = setuptools.find_packages(),
   package_data      = dict(kanjidraw = ["data.json"]),
   entry_points      = dict(
-    console_scripts = ["kanjidraw = kanjidraw.gui:main"]
+    console_scripts = ["kanjidraw = kanjidraw.gui:main",
+                       "kanjidraw-replay = kanjidraw.replay:main"]
   ),
   python_requires   = ">=3.5",
 )